@@ -7,15 +7,40 @@
                 based on the layers in the selected map then sets sharing.
 -------------------------------------------------------------------------------"""
 import arcpy
-from arcgis.gis import GIS
 import os
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache, partial, wraps
+import hashlib
+import shutil
+import sys
 import tempfile
+import threading
+import time
 from pathlib import Path
 
+# size of each part when uploading a service definition with addPart
+SD_CHUNK_SIZE = 50 * 1024 * 1024
+# seconds to wait for the portal to assemble an uploaded service definition
+SD_COMMIT_TIMEOUT = 30 * 60
+# staged service definitions from previous runs, keyed by map fingerprint
+SD_CACHE_DIR = Path(os.environ.get("LOCALAPPDATA", tempfile.gettempdir()), "update_agol", "sd_cache")
+# cached service definitions unused for this long are deleted
+SD_CACHE_MAX_AGE_DAYS = 7
+# file geodatabases and other workspaces whose tables are not paths of their own
+_WORKSPACE_SUFFIXES = {".gdb", ".gpkg", ".sqlite", ".geodatabase", ".mdb"}
+_MESSAGE_LOCK = threading.Lock()
+_LOGIN_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+# last opened project and its looked up maps, keyed by (path, mtime) so a saved .aprx is reopened
+_PROJECT_CACHE = {}
+
 
 class UpdateAGOL(object):
+    # validation caches shared by every instance ArcGIS Pro creates, keyed by a hash of the login fields
+    _login_futures = {}
+    _user_content_cache = {}
+
     def __init__(self):
         """Define the tool (tool name is the name of the class)."""
         self.label = "Update Feature Service in AGOL"
@@ -105,6 +130,17 @@ class UpdateAGOL(object):
             category="Sharing",
         )
         shr_to_everyone.value = "True"
+        # set 5 of parameters - staging options
+        max_workers = arcpy.Parameter(
+            name="max_workers",
+            displayName="Parallel upload requests",
+            parameterType="Optional",
+            datatype="GPLong",
+            category="Staging",
+        )
+        max_workers.value = 3
+        max_workers.filter.type = "Range"
+        max_workers.filter.list = [1, 16]
         params = [
             portal_url,
             admin_user,
@@ -116,6 +152,7 @@ class UpdateAGOL(object):
             map_name,
             shr_to_org,
             shr_to_everyone,
+            max_workers,
         ]
         return params
 
@@ -125,53 +162,76 @@ class UpdateAGOL(object):
 
     def updateParameters(self, parameters):
         # Dropdown for users
-        if parameters[0].altered or parameters[1].altered or parameters[2].altered:
-            if parameters[0].value and parameters[1].value and parameters[2].value:
-                user_list = []
-                arcpy.AddMessage(parameters[0])
-                portal = GIS(url=parameters[0].value, username=parameters[1].value, password=parameters[2].value,)
-                portal_users = portal.users.search("!esri_ & !system_publisher", max_users=10000)
-                for user in portal_users:
-                    user_list.append(user.username)
-                user_filter = parameters[3].filter
-                user_filter.list = user_list
+        portal_url, admin_user, admin_pass = (param.value for param in parameters[:3])
+        # the portal is only contacted once all three login fields are filled in
+        login = None
+        if portal_url and admin_user and admin_pass:
+            # log in and list users in the background while the rest of the dialog is filled in
+            key = self._start_login(portal_url, admin_user, admin_pass)
+            # opening the owner dropdown doesn't revalidate, so fill it in the call where the login fields
+            # changed; otherwise only block on the login once the content owner is needed
+            login_changed = any(param.altered and not param.hasBeenValidated for param in parameters[:3])
+            login = self._login_result(key, wait=login_changed or bool(parameters[3].value))
+        if login is not None:
+            portal, users_by_name = login
+            user_filter = parameters[3].filter
+            user_filter.list = list(users_by_name)
         # Dropdown for content associated with chosen user
-        if (parameters[0].value and parameters[1].value and parameters[2].value and parameters[3].value):
-            content_list = []
-            group_list = []
-            for user in portal_users:
-                if user.username == parameters[3].value:
-                    group_list = [str(group.title) for group in user.groups]
-                    user_content = user.items()
-                    for item in user_content:
-                        if str(item.type) == "Feature Service":
-                            content_list.append(str(item.title))
-                    user_folders = user.folders
-                    for folder in user_folders:
-                        user_content = user.items(folder=folder["title"])
-                        for item in user_content:
-                            if str(item.type) == "Feature Service":
-                                content_list.append(str(item.title))
+        if login is not None and parameters[3].value in users_by_name:
+            content_key = (key, parameters[3].value)
+            if content_key not in self._user_content_cache:
+                # only the selected owner is materialized as a full User object
+                user = _get_user_class()(portal, parameters[3].value)
+                # the group and content lookups are independent requests, run them side by side
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    groups_future = executor.submit(lambda: user.groups)
+                    # owner: matches items in every folder, one search replaces a request per folder
+                    content_future = executor.submit(portal.content.search,
+                                                     query=f'owner:"{_lucene_escape(user.username)}"',
+                                                     item_type="Feature Service", max_items=10000,
+                                                     sort_field="title", sort_order="asc", )
+                group_list = [str(group.title) for group in groups_future.result()]
+                user_content = content_future.result()
+                content_list = [str(item.title) for item in user_content if str(item.type) == "Feature Service"]
+                # content comes back sorted by title from the portal
+                group_list.sort()
+                self._user_content_cache[content_key] = (group_list, content_list)
+            group_list, content_list = self._user_content_cache[content_key]
             # load user groups
-            group_list.sort()
             group_filter = parameters[5].filter
             group_filter.list = group_list
             # load user content
-            content_list.sort()
             content_filter = parameters[4].filter
             content_filter.list = content_list
 
         # dropdown for maps in apro project
         if parameters[6].altered:
             if parameters[6].value:
-                prj = arcpy.mp.ArcGISProject(parameters[6].value)
-                map_list = [str(mp.name) for mp in prj.listMaps()]
                 # load map names
-                map_list.sort()
+                map_list = sorted(_project_maps(str(parameters[6].value)))
                 map_filter = parameters[7].filter
                 map_filter.list = map_list
         return
 
+    def _start_login(self, portal_url, admin_user, admin_pass):
+        """Submit the portal login unless it is already running or done, and return its key"""
+        key = hashlib.blake2b(f"{portal_url}\0{admin_user}\0{admin_pass}".encode()).hexdigest()
+        if key not in self._login_futures:
+            self._login_futures[key] = _LOGIN_EXECUTOR.submit(_portal_login, portal_url, admin_user, admin_pass)
+        return key
+
+    def _login_result(self, key, wait):
+        """(portal, users by name) for the login key, or None if it is still running and wait is False"""
+        future = self._login_futures[key]
+        if not wait and not future.done():
+            return None
+        try:
+            return future.result()
+        except Exception:
+            # don't keep a failed login around, retry it on the next validation
+            del self._login_futures[key]
+            raise
+
     def updateMessages(self, parameters):
         """Modify the messages created by internal validation for each tool
         parameter.  This method is called after internal validation."""
@@ -179,6 +239,8 @@ class UpdateAGOL(object):
 
     def execute(self, parameters, messages):
         """The source code of the tool."""
+        # only execute needs these, importing them here keeps the tool dialog quick to open
+        import asyncio
         arcpy.env.overwriteOutput = True
         """ variables given"""
         # portal_url = parameters[0].valueAsText
@@ -191,61 +253,53 @@ class UpdateAGOL(object):
         # map_name = parameters[7].valueAsText
         # share_to_org = parameters[8].valueAsText
         # share_to_everyone = parameters[9].valueAsText
+        # max_workers = parameters[10].valueAsText
 
-        portal_url = parameters[0]
-        admin_user = parameters[1]
-        admin_pass = parameters[2]
-        content_owner = parameters[3]
-        service_name = parameters[4]
-        group_names = parameters[5]
-        pro_project = parameters[6]
-        map_name = parameters[7]
-        share_to_org = parameters[8]
-        share_to_everyone = parameters[9]
-        if group_names == "":
-            group_names = []
-        else:
-            group_names = group_names.split(";")
+        # text parameters through valueAsText, the others once by value
+        portal_url, admin_user, admin_pass, content_owner, service_name = _vals(parameters[:5])
+        pro_project, map_name = _vals(parameters[6:8])
+        # valueAsText quotes multivalue entries with spaces ('Planning Team';Ops), read the names as a list
+        group_names = [str(name) for name in parameters[5].values or []]
+        share_to_org, share_to_everyone = (bool(param.value) for param in parameters[8:10])
+        max_workers = parameters[10].value
+        # keep below AGOL's rate limits, the parameter lets users throttle further; clamp to the
+        # parameter's 1-16 range here too, the __main__ harness skips the dialog's filter
+        max_workers = min(16, max(1, int(max_workers))) if max_workers else 3
 
         """ date and time variable """
-        now = datetime.now()
-        time_string = datetime.strftime(now, '%Y-%d-%m_%I%M')
+        time_string = datetime.now().strftime('%Y-%d-%m_%I%M')
 
         """ main work """
-        # with tempfile.TemporaryDirectory() as LOCAL_PATH:
-        LOCAL_PATH = os.path.dirname(pro_project)
-        draft_path = os.path.join(LOCAL_PATH, f"{time_string}_WebUpdate.sddraft")
-        SD_path = os.path.join(LOCAL_PATH, f"{time_string}_WebUpdate.sd")
-
-        arcpy.AddMessage("...Creating Service Definition from map layers...")
-        stage_features(project=pro_project, prj_map=map_name, service=service_name,
-                       draft=draft_path, definition=SD_path, )
-
-        arcpy.AddMessage(f"...Connecting to {portal_url}")
-        gis = GIS(url=portal_url, username=admin_user, password=admin_pass)
-        share_with_groups = [
-            get_group_id(group_name=group, owner=content_owner, gis=gis)
-            for group in group_names
-        ]
-        # check to see if the service exists and overwrite, otherwise publish new service
-        try:
-            arcpy.AddMessage("Looking for original service definition on portal...")
-            service_def_item = gis.content.search(query=f"title:{service_name} AND owner:{content_owner}",
-                                                  item_type="Service Definition", )[0]
-            arcpy.AddMessage(
-                f"\tFound SD: {service_def_item.title}, \n\tID: {service_def_item.id} \n\t\tUploading and overwriting…"
-            )
-            service_def_item.update(data=str(SD_path))
-            arcpy.AddMessage(service_def_item)
-            arcpy.AddMessage("\tOverwriting existing feature service…")
-            feature_service = service_def_item.publish(overwrite=True)
-            # TODO: getting error here, not overwriting and then failing in except as this item exists
-        except:
-            arcpy.AddMessage("The service doesn't exist, creating new")
-            arcpy.AddMessage("...uploading new content")
-            source_item = gis.content.add(item_properties={}, data=str(SD_path))
-            print("...publisihing new content")
-            feature_service = source_item.publish()
+        # stage on the local temp drive, projects often live on slow network shares; the staged .sd is kept
+        # in SD_CACHE_DIR so nothing needs copying back next to the project
+        with tempfile.TemporaryDirectory(prefix="agol_sd_") as LOCAL_PATH:
+            # arcpy's geoprocessing tools want plain string paths
+            SD_path = str(Path(LOCAL_PATH, f"{time_string}_WebUpdate.sd"))
+            draft_path = f"{SD_path}draft"
+
+            # reuse the login from validation if there is one, otherwise start it now so it overlaps staging
+            login_key = self._start_login(portal_url, admin_user, admin_pass)
+            # fail before staging if the map isn't in the project
+            _get_map(pro_project, map_name)
+            arcpy.AddMessage("...Creating Service Definition from map layers...")
+            # staging is long and local, run it in its own process while connecting and searching the portal
+            stage_process = start_staging(project=pro_project, prj_map=map_name, service=service_name,
+                                          draft=draft_path, definition=SD_path, )
+            try:
+                arcpy.AddMessage(f"...Connecting to {portal_url}")
+                gis, _ = self._login_result(login_key, wait=True)
+                session = pooled_session(gis, pool_size=max(16, max_workers))
+                feature_service, share_with_groups = asyncio.run(
+                    publish_service(gis=gis, session=session, service=service_name, owner=content_owner,
+                                    definition=SD_path, group_names=group_names, stage_process=stage_process,
+                                    max_workers=max_workers, )
+                )
+            finally:
+                # stop staging if the portal side failed, the temp directory can't be removed while it writes
+                if stage_process is not None:
+                    if stage_process.is_alive():
+                        stage_process.terminate()
+                    stage_process.join()
 
         # share updated/new feature service
         if share_to_org or share_to_everyone or share_with_groups:
@@ -255,33 +309,454 @@ class UpdateAGOL(object):
         return
 
 
-def stage_features(project, prj_map, service, draft, definition):
-    prj = arcpy.mp.ArcGISProject(project)
-    for m in prj.listMaps():
-        if m.name == prj_map:
-            arcpy.mp.CreateWebLayerSDDraft(map_or_layers=m, out_sddraft=draft, service_name=service,
-                                           server_type="HOSTING_SERVER", service_type="FEATURE_ACCESS",
-                                           folder_name="", overwrite_existing_service=True,
-                                           copy_data_to_server=True, enable_editing=True, )
-            arcpy.StageService_server(in_service_definition_draft=draft, out_service_definition=definition,)
+async def publish_service(gis, session, service, owner, definition, group_names, stage_process, max_workers=3):
+    """Upload and publish the service definition once staging finishes, resolving the sharing groups meanwhile"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    groups_task = loop.run_in_executor(None, get_group_ids, group_names, owner, gis)
+    # check to see if the service exists and overwrite, otherwise publish new service
+    arcpy.AddMessage("Looking for original service definition on portal...")
+    # the SD lookup and the group lookup are the only two searches, run them side by side
+    service_def_item = await loop.run_in_executor(None, find_service_definition, gis, service, owner)
+    if stage_process is not None:
+        await loop.run_in_executor(None, stage_process.join)
+        if stage_process.exitcode != 0:
+            error = _staging_error(definition)
+            if error:
+                arcpy.AddError(error)
+            raise RuntimeError(f"Staging {definition} failed with exit code {stage_process.exitcode}")
+    if service_def_item is not None:
+        arcpy.AddMessage(
+            f"\tFound SD: {service_def_item.title}, \n\tID: {service_def_item.id} \n\t\tUploading and overwriting…"
+        )
+        upload_task = loop.run_in_executor(None, partial(upload_sd_multipart, service_def_item, definition, gis,
+                                                         session, max_workers=max_workers))
+        await asyncio.gather(upload_task, groups_task)
+        arcpy.AddMessage(service_def_item)
+        arcpy.AddMessage("\tOverwriting existing feature service…")
+        feature_service = service_def_item.publish(overwrite=True)
+    else:
+        arcpy.AddMessage("The service doesn't exist, creating new")
+        arcpy.AddMessage("...uploading new content")
+        upload_task = loop.run_in_executor(None, partial(gis.content.add, item_properties={}, data=str(definition)))
+        source_item, _ = await asyncio.gather(upload_task, groups_task)
+        print("...publisihing new content")
+        feature_service = source_item.publish()
+    return feature_service, await groups_task
+
+
+def _message(text):
+    """arcpy.AddMessage for worker threads, arcpy messaging is not safe to call concurrently"""
+    with _MESSAGE_LOCK:
+        arcpy.AddMessage(text)
+
+
+def _lucene_escape(value):
+    """Escape a value for use inside a double-quoted portal search term"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _portal_login(portal_url, admin_user, admin_pass):
+    """Log in to the portal and index the org's users by username"""
+    portal = _get_gis_class()(url=portal_url, username=admin_user, password=admin_pass,)
+    portal_users = portal.users.advanced_search(query="!esri_ & !system_publisher",
+                                                max_users=10000, as_dict=True)["results"]
+    return portal, {user["username"]: user for user in portal_users}
+
+
+def _vals(params):
+    """Read every parameter's text value once"""
+    return tuple(param.valueAsText for param in params)
+
+
+@lru_cache(maxsize=None)
+def _get_gis_class():
+    """Import arcgis only when a portal connection is actually needed, it is slow to load"""
+    from arcgis.gis import GIS
+    return GIS
+
+
+@lru_cache(maxsize=None)
+def _get_user_class():
+    from arcgis.gis import User
+    return User
+
 
+@lru_cache(maxsize=None)
+def _get_multipart_encoder_class():
+    """Import requests_toolbelt only when a service definition is uploaded"""
+    from requests_toolbelt import MultipartEncoder
+    return MultipartEncoder
 
-def get_group_id(group_name, owner, gis):
+
+def _with_backoff(max_tries=3, base_delay=1, max_retry_after=30):
+    """Retry an idempotent portal request on network errors, doubling the wait after each attempt
+
+    A 429 waits for the portal's Retry-After instead, capped at max_retry_after seconds.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            import requests
+            for attempt in range(max_tries):
+                try:
+                    return func(*args, **kwargs)
+                except requests.exceptions.RequestException as e:
+                    if attempt == max_tries - 1:
+                        raise
+                    retry_after = _retry_after(e)
+                    if retry_after is None:
+                        time.sleep(base_delay * 2 ** attempt)
+                    else:
+                        time.sleep(min(retry_after, max_retry_after))
+        return wrapper
+    return decorator
+
+
+def _retry_after(error):
+    """Seconds a rate limited (429) response asks to wait, or None for any other error"""
+    response = getattr(error, "response", None)
+    if response is None or response.status_code != 429:
+        return None
     try:
-        group = gis.groups.search(query=f"title: {group_name} AND owner: {owner}")
-        return group[0].id
-    except:
+        return max(0.0, float(response.headers.get("Retry-After", 1)))
+    except ValueError:
+        # an HTTP date instead of seconds, back off for one second
+        return 1.0
+
+
+@_with_backoff()
+def find_service_definition(gis, service, owner):
+    """Return the owner's Service Definition item for the service, or None if it hasn't been published"""
+    results = gis.content.advanced_search(
+        query=f'title:"{_lucene_escape(service)}" AND owner:"{_lucene_escape(owner)}" AND type:"Service Definition"',
+        max_items=100, as_dict=True,
+    )
+    # title:"..." is a phrase match, "Parcels" also finds "Parcels 2020", keep the exact title only
+    for result in results.get("results", []):
+        if result["title"] == service and result["type"] == "Service Definition":
+            return gis.content.get(result["id"])
+    return None
+
+
+def upload_sd_multipart(item, definition, gis, session, chunk_size=SD_CHUNK_SIZE, max_workers=3,
+                        commit_timeout=SD_COMMIT_TIMEOUT):
+    """Replace the file behind a Service Definition item using the multipart addPart/commit endpoints"""
+    item_url = f"{gis._portal.resturl}content/users/{item.owner}/items/{item.id}"
+    params = {"f": "json", "token": gis._con.token}
+    file_size = os.path.getsize(definition)
+    part_offsets = range(0, file_size, chunk_size)
+
+    @_with_backoff()
+    def add_part(part_num, offset):
+        # stream each part from disk, requests' own multipart encoding would hold the whole part in memory
+        with open(definition, "rb") as sd_file:
+            sd_file.seek(offset)
+            part = _FilePart(sd_file, min(chunk_size, file_size - offset))
+            encoder = _get_multipart_encoder_class()(fields={**params, "partNum": str(part_num),
+                                               "file": (Path(definition).name, part, "application/octet-stream")})
+            _check_response(session.post(f"{item_url}/addPart", data=encoder,
+                                         headers={"Content-Type": encoder.content_type}, ))
+        _message(f"\t\tUploaded part {part_num} of {len(part_offsets)}")
+
+    _check_response(session.post(f"{item_url}/update",
+                                 data={**params, "multipart": "true", "filename": Path(definition).name}, ))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # list() so a failed part raises here rather than being dropped
+        list(executor.map(add_part, range(1, len(part_offsets) + 1), part_offsets))
+    _check_response(session.post(f"{item_url}/commit", data=params))
+    # commit is asynchronous, wait for the portal to finish assembling the parts
+    deadline = time.monotonic() + commit_timeout
+    while True:
+        status = _check_response(session.get(f"{item_url}/status", params=params))
+        if status.get("status") == "completed":
+            break
+        # partial and processing are both in-progress states of the commit
+        if status.get("status") not in ("partial", "processing"):
+            raise RuntimeError(f"Multipart upload of {definition} failed with status {status.get('status')}: "
+                               f"{status.get('statusMessage')}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Multipart upload of {definition} still processing after {commit_timeout} s")
+        time.sleep(1)
+    return item
+
+
+class _FilePart(object):
+    """Read at most length bytes from an open file's current position, so a part can be streamed"""
+
+    def __init__(self, file, length):
+        self._file = file
+        self._length = length
+        self._position = 0
+
+    def __len__(self):
+        # MultipartEncoder reads len() as the bytes still to send, for Content-Length and to know when a part is done
+        return self._length - self._position
+
+    def read(self, size=-1):
+        remaining = self._length - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self._file.read(size)
+        self._position += len(data)
+        return data
+
+
+def pooled_session(gis, pool_size=16):
+    """Return a keep-alive requests session for REST calls, reusing the GIS connection's own session if it has one"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = getattr(gis._con, "_session", None)
+    if not isinstance(session, requests.Session):
+        session = requests.Session()
+    # urllib3 only retries idempotent methods by default, so uploads and commits are never replayed
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries))
+    session.headers["Connection"] = "keep-alive"
+    return session
+
+
+def _check_response(response):
+    """Return the JSON body of a portal REST response, raising on HTTP or portal errors"""
+    response.raise_for_status()
+    body = response.json()
+    if "error" in body:
+        raise RuntimeError(f"Portal request to {response.url} failed: {body['error']}")
+    return body
+
+
+def start_staging(project, prj_map, service, draft, definition):
+    """Run stage_features in a child process and return the started Process
+
+    Returns None without starting a process when the cached .sd can be reused, spawning a child
+    and importing arcpy in it costs more than the copy.
+    """
+    _prune_sd_cache()
+    fingerprint = _staging_fingerprint(project=project, prj_map=prj_map, service=service)
+    if _reuse_cached_sd(fingerprint=fingerprint, definition=definition):
         return None
+    import multiprocessing
+    # inside ArcGIS Pro sys.executable is ArcGISPro.exe, child processes need the env's python
+    if not Path(sys.executable).name.lower().startswith("python"):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+    stage_process = multiprocessing.Process(target=_stage_in_child, kwargs=dict(
+        project=project, prj_map=prj_map, service=service, draft=draft, definition=definition,
+        fingerprint=fingerprint, ))
+    stage_process.start()
+    return stage_process
 
 
-def get_wm_item_id(gis, wm_title, item_type="Web Map"):
+def _stage_in_child(**kwargs):
+    """stage_features for the staging process, leaving the error text next to the .sd if it fails"""
     try:
-        wm_search = gis.content.search(f"title: {wm_title}", item_type=item_type)
-        for wm in wm_search:
-            if wm.title == wm_title:
-                return wm.id
-    except AttributeError:
-        print("no web map by that name exists, cannot find id to publish")
+        stage_features(**kwargs)
+    except Exception as e:
+        # a file rather than a multiprocessing.Queue, a queued message bigger than the pipe buffer
+        # keeps the child from exiting while the parent joins it; an ExecuteError's text is the GP messages
+        Path(f"{kwargs['definition']}.error").write_text(str(e), encoding="utf-8")
+        raise
+
+
+def _staging_error(definition):
+    """The error text a failed staging process left for definition, or None"""
+    try:
+        return Path(f"{definition}.error").read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+def stage_features(project, prj_map, service, draft, definition, fingerprint=None):
+    """Stage the map's service definition, storing it in the SD cache under fingerprint
+
+    start_staging has already fingerprinted the map and found no cached .sd, so neither is repeated here.
+    """
+    m = _get_map(project, prj_map)
+    cached_sd = SD_CACHE_DIR / f"{fingerprint}.sd" if fingerprint else None
+    arcpy.mp.CreateWebLayerSDDraft(map_or_layers=m, out_sddraft=draft, service_name=service,
+                                   server_type="HOSTING_SERVER", service_type="FEATURE_ACCESS",
+                                   folder_name="", overwrite_existing_service=True,
+                                   copy_data_to_server=True, enable_editing=True, )
+    arcpy.StageService_server(in_service_definition_draft=draft, out_service_definition=definition,)
+    if cached_sd is not None:
+        _store_cached_sd(definition, cached_sd)
+
+
+def _reuse_cached_sd(fingerprint, definition):
+    """Copy the cached .sd for an unchanged map to definition, returning False if there isn't one"""
+    cached_sd = SD_CACHE_DIR / f"{fingerprint}.sd" if fingerprint else None
+    if cached_sd is None or not cached_sd.exists():
+        return False
+    arcpy.AddMessage("...Map unchanged since it was last staged, reusing cached service definition")
+    _link_or_copy(cached_sd, definition)
+    # mark it as recently used so pruning keeps it
+    os.utime(cached_sd)
+    return True
+
+
+def _store_cached_sd(definition, cached_sd):
+    """Add a staged .sd to the cache atomically, an interrupted copy must never look like a cached .sd"""
+    SD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    partial_sd = cached_sd.with_name(f"{cached_sd.name}.{os.getpid()}.tmp")
+    try:
+        _link_or_copy(definition, partial_sd)
+        os.replace(partial_sd, cached_sd)
+    except BaseException:
+        try:
+            os.unlink(partial_sd)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _link_or_copy(src, dst):
+    """Hard link dst to src so a large .sd isn't duplicated on disk, copying when linking isn't possible"""
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        # different volumes, or a file system without hard links
+        shutil.copyfile(src, dst)
+
+
+def _staging_fingerprint(project, prj_map, service):
+    """Fingerprint of a map for the SD cache, or None if it can't be cached"""
+    m = _get_map(project, prj_map)
+    # walk the layer tree once, group layers have no data source of their own and
+    # CreateWebLayerSDDraft leaves basemaps out of the service; standalone tables are published too
+    sources = [lyr for lyr in m.listLayers() if lyr.supports("DATASOURCE") and not lyr.isBasemapLayer]
+    sources.extend(m.listTables())
+    return map_fingerprint(map_name=m.name, sources=sources, project=project, service=service)
+
+
+def _prune_sd_cache(max_age_days=SD_CACHE_MAX_AGE_DAYS):
+    """Delete cached .sd files that haven't been staged or reused for max_age_days, in one directory pass"""
+    if not SD_CACHE_DIR.exists():
+        return
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    with os.scandir(SD_CACHE_DIR) as entries:
+        for entry in entries:
+            # scandir already has the stat data on Windows, no extra call per file
+            # .tmp files are copies left behind by a terminated staging process
+            if entry.name.endswith((".sd", ".tmp")) and entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+
+
+def _project_maps(path):
+    """The project's maps by name, listed once while the .aprx is unchanged"""
+    prj, maps = _cached_project(path)
+    if not maps:
+        maps.update((str(m.name), m) for m in prj.listMaps())
+    return maps
+
+
+def _get_map(path, map_name):
+    """Return the named map from a project, reusing the map object while the .aprx is unchanged"""
+    maps = _project_maps(path)
+    if map_name not in maps:
+        raise ValueError(f"No map named {map_name} in {path}")
+    return maps[map_name]
+
+
+def _cached_project(path):
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _PROJECT_CACHE:
+        _PROJECT_CACHE.clear()
+        _PROJECT_CACHE[key] = (arcpy.mp.ArcGISProject(path), {})
+    return _PROJECT_CACHE[key]
+
+
+def _is_registered_source(data_source):
+    data_source = data_source.lower()
+    return data_source.startswith("http") or ".sde" in data_source
+
+
+def map_fingerprint(map_name, sources, project, service):
+    """Hash the saved project and the data sources of the map's layers and tables with their modified times
+
+    The .aprx mtime covers symbology, queries and other layer properties saved in the project.
+    Returns None if any source can't be checked locally.
+    """
+    layer_sources = []
+    for source in sources:
+        # a service or .sde connection file says nothing about when its data last changed
+        mtime = None if _is_registered_source(source.dataSource) else _source_mtime(source.dataSource)
+        if mtime is None:
+            return None
+        layer_sources.append((source.dataSource, repr(source.connectionProperties), mtime))
+    project_mtime = os.stat(project).st_mtime_ns
+    return hashlib.blake2b(repr((map_name, project_mtime, service, layer_sources)).encode(),
+                           digest_size=16).hexdigest()
+
+
+def _source_mtime(data_source):
+    """Newest modified time of a data source's files, in one directory pass
+
+    A feature class falls back to its workspace (e.g. the .gdb) and takes the newest file in it, rewriting
+    a file doesn't change the directory's own mtime. A file such as a .shp includes its sidecar files
+    (.dbf, .shx, ...) so attribute-only edits are seen. Returns None for a broken source, rather than
+    fingerprinting whatever folder above it still exists.
+    """
+    path = Path(data_source)
+    if not path.exists():
+        # only a feature class or table inside a workspace is not a path of its own
+        workspace = next((parent for parent in path.parents if parent.suffix.lower() in _WORKSPACE_SUFFIXES),
+                         None)
+        if workspace is None or not workspace.exists():
+            return None
+        path = workspace
+    if path.is_dir():
+        folder, prefix = path, ""
+    else:
+        folder, prefix = path.parent, f"{path.stem}."
+    newest = path.stat().st_mtime_ns
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            # scandir already has the stat data on Windows, no extra call per file
+            if entry.name.startswith(prefix) and entry.is_file():
+                newest = max(newest, entry.stat().st_mtime_ns)
+    return newest
+
+
+def get_group_ids(group_names, owner, gis):
+    """Resolve group titles to ids from the groups the owner owns or belongs to; unmatched titles resolve to None"""
+    if not group_names:
+        return []
+    # the same list the groups dropdown is built from, so a title maps to the group the user picked
+    ids_by_title = {group.title: group.id for group in _user_groups(gis, owner)}
+    return [ids_by_title.get(group_name) for group_name in group_names]
+
+
+@_with_backoff()
+def _user_groups(gis, username):
+    return _get_user_class()(gis, username).groups
+
+
+@_with_backoff()
+def _search_groups(gis, query, max_groups=100):
+    return gis.groups.search(query=query, max_groups=max_groups)
+
+
+def get_group_id(group_name, gis):
+    # network errors and rate limiting are retried then raised, only a missing group resolves to None
+    groups = _search_groups(gis, query=f'title:"{_lucene_escape(group_name)}"')
+    # title:"..." is a phrase match, "GIS" also finds "GIS Editors", keep the exact title only
+    for group in groups:
+        if group.title == group_name:
+            return group.id
+    return None
+
+
+@_with_backoff()
+def get_wm_item_id(gis, wm_title, item_type="Web Map"):
+    wm_search = gis.content.search(f'title:"{_lucene_escape(wm_title)}"', item_type=item_type)
+    for wm in wm_search:
+        if wm.title == wm_title:
+            return wm.id
+    print("no web map by that name exists, cannot find id to publish")
 
 
 if __name__ == "__main__":
@@ -297,6 +772,7 @@ if __name__ == "__main__":
     # map_name = parameters[7].valueAsText
     # share_to_org = parameters[8].valueAsText
     # share_to_everyone = parameters[9].valueAsText
+    # max_workers = parameters[10].valueAsText
 
     portal_url = "https://arcgis.com"
     admin_user = "Developer_CTW"
@@ -308,7 +784,11 @@ if __name__ == "__main__":
     map_name = "Trend Tile Services"
     share_to_org = False
     share_to_everyone = False
-    parameters = [portal_url, admin_user, admin_pass, content_owner, service_name,
-                  group_names, pro_project, map_name, share_to_org, share_to_everyone]
+    max_workers = 3
+    values = [portal_url, admin_user, admin_pass, content_owner, service_name,
+              group_names, pro_project, map_name, share_to_org, share_to_everyone, max_workers]
     tool = UpdateAGOL()
+    parameters = tool.getParameterInfo()
+    for param, value in zip(parameters, values):
+        param.value = value
     tool.execute(parameters=parameters, messages="")
\ No newline at end of file